@@ -0,0 +1,51 @@
+import os
+import time
+import orjson
+import shutil
+import hashlib
+
+from pathlib import Path
+
+CACHE_DIR = ".cache"
+
+def _cache_paths(key):
+	"""key is a tuple (symbol, endpoint, from, to). Returns (json path, timestamp path)."""
+	symbol, endpoint = key[0], key[1]
+	digest = hashlib.md5(repr(key).encode()).hexdigest()
+	base = Path(CACHE_DIR) / endpoint / str(symbol) / digest
+	return base.with_suffix(".json"), base.with_suffix(".ts")
+
+def _write_atomic(path, data):
+	tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{time.monotonic_ns()}.tmp")
+	tmp_path.write_bytes(data)
+	os.replace(tmp_path, path)
+
+def get_or_fetch(key, fetch_fn, ttl_seconds=None, final_after=None):
+	"""
+	Returns the cached json payload for key if it is younger than ttl_seconds
+	(None = never expires), otherwise calls fetch_fn() and caches its result.
+	An entry fetched after final_after (unix seconds, e.g. a day past the end of
+	the queried range) holds final data and never expires, whatever ttl_seconds.
+	A None result from fetch_fn is returned but not cached.
+	"""
+	json_path, ts_path = _cache_paths(key)
+
+	try:
+		fetched_at = float(ts_path.read_text())
+		is_final = final_after is not None and fetched_at > final_after
+		if is_final or ttl_seconds is None or time.time() - fetched_at < ttl_seconds:
+			return orjson.loads(json_path.read_bytes())
+	except (OSError, ValueError):
+		pass
+
+	data = fetch_fn()
+	if data is not None:
+		json_path.parent.mkdir(parents=True, exist_ok=True)
+		_write_atomic(json_path, orjson.dumps(data))
+		_write_atomic(ts_path, str(time.time()).encode())
+
+	return data
+
+def evict(symbol, endpoint):
+	"""Drops every cached entry of symbol for endpoint, e.g. once its data is persisted elsewhere."""
+	shutil.rmtree(Path(CACHE_DIR) / endpoint / str(symbol), ignore_errors=True)
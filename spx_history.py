@@ -1,13 +1,135 @@
 import os
 import qt
 import time
+import random
+import shutil
+import calendar
+import orjson
 import requests
+import threading
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+import spx_cache
 
 from qt import dt, np, pd, os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 EODHD_API_KEY = os.environ.get('EODHD_API_KEY')
 
+# cache ttl for split / dividend responses and for intraday chunks touching the last day
+EVENTS_CACHE_TTL = 24 * 3600
+ROLLING_CHUNK_CACHE_TTL = 3600
+
+class JitteredRetry(Retry):
+	"""urllib3 Retry with random jitter added to the exponential backoff."""
+	def get_backoff_time(self):
+		backoff = super().get_backoff_time()
+		if backoff <= 0:
+			return backoff
+		return backoff + random.uniform(0, 0.25 * 2 ** len(self.history))
+
+	def increment(self, *args, **kwargs):
+		new_retry = super().increment(*args, **kwargs)
+
+		# a 429 means the quota is spent : empty the shared bucket before anything else goes out
+		response = kwargs.get("response")
+		if response is not None and response.status == 429:
+			BUCKET.drain()
+
+		# every resend costs a token like the first attempt
+		BUCKET.acquire()
+		return new_retry
+
+# retry 429 / 5xx with exponential backoff, honouring the Retry-After header
+RETRY = JitteredRetry(
+	total=5,
+	backoff_factor=0.5,
+	status_forcelist=(429, 500, 502, 503, 504),
+	allowed_methods=frozenset(['GET']),
+	respect_retry_after_header=True
+)
+
+class TokenBucket:
+	"""Thread-safe token bucket limiting the request rate across all download threads."""
+	def __init__(self, rate, capacity):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+	def drain(self):
+		with self.lock:
+			self.tokens = 0
+			self.updated = time.monotonic()
+
+# eodhd allows 1000 api calls per minute
+BUCKET = TokenBucket(rate=1000 / 60, capacity=20)
+
+# shared http session (keep-alive connection pool to eodhd.com)
+SESSION = requests.Session()
+SESSION.headers.update({'Accept': 'application/json'})
+
+def size_session_pool(pool_maxsize):
+	"""(Re)mounts SESSION's https adapter so it keeps pool_maxsize connections alive (>= number of download threads)."""
+	global POOL_MAXSIZE
+	SESSION.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=pool_maxsize, max_retries=RETRY))
+	POOL_MAXSIZE = pool_maxsize
+
+size_session_pool(64)
+
+# split / dividend columns and dtypes, used for empty responses
+SPLIT_DTYPES = {
+	"date": "object",
+	"split": "object"
+}
+DIV_DTYPES = {
+	"date": "object",
+	"declarationDate": "object",
+	"recordDate": "object",
+	"paymentDate": "object",
+	"period": "object",
+	"value": "float64",
+	"unadjustedValue": "float32",
+	"currency": "object"
+}
+
+def _get_json(url, params, timeout=None):
+	"""
+	Rate limited GET returning the decoded json body. The body is streamed in 64 kB pieces and the
+	connection is handed back to the pool as soon as it is read. Non-json (error) bodies raise
+	with the response text.
+	"""
+	BUCKET.acquire()
+	with SESSION.get(url, params=params, timeout=timeout, stream=True) as response:
+		response.raise_for_status()
+		body = b"".join(response.iter_content(65536))
+
+	# unknown symbols / empty ranges come back as [] (or null / nothing), skip the parser
+	if body in (b"[]", b"null", b""):
+		return []
+
+	try:
+		return orjson.loads(body)
+	except orjson.JSONDecodeError:
+		raise ValueError(f"non-json response ({response.status_code}) : {body[:200].decode(errors='replace')}")
+
 def get_splits(symbol, start_date, end_date, api_token=EODHD_API_KEY):
 	"""Fetches split events. Format: 2024-06-07, 10.0 (for a 10-for-1 split)"""
 	url = f"https://eodhd.com/api/splits/{symbol}"
@@ -19,11 +141,24 @@ def get_splits(symbol, start_date, end_date, api_token=EODHD_API_KEY):
 	}
 	try:
 		qt.log.info(f"querying split data for symbol {symbol}")
-		response = requests.get(url, params=params)
-		ts = pd.DataFrame(response.json())
+		def fetch():
+			return _get_json(url, params)
+
+		key = (symbol, "split", str(start_date), str(end_date))
+		data = spx_cache.get_or_fetch(key, fetch, ttl_seconds=EVENTS_CACHE_TTL)
+		if not data:
+			qt.log.info(f"no split data for symbol {symbol}")
+			return pd.DataFrame(columns=list(SPLIT_DTYPES)).astype(SPLIT_DTYPES)
+
+		ts = pd.json_normalize(data)
 		qt.log.info(f"returned {ts.shape} rows")
 		return ts
 
+	# http / network errors are raised so download_data can tell transient from permanent failures
+	except requests.RequestException as e:
+		qt.log.warning(f"couldnt query split data for stock {symbol}, error : {e}")
+		raise
+
 	except Exception as e:
 		qt.log.warning(f"couldnt query split data for stock {symbol}, error : {e}")
 		return pd.DataFrame()
@@ -39,163 +174,479 @@ def get_dividends(symbol, start_date, end_date, api_token=EODHD_API_KEY):
 	}
 	try:
 		qt.log.info(f"querying dividend data for symbol {symbol}")
-		response = requests.get(url, params=params)
-		td = pd.DataFrame(response.json())
+		def fetch():
+			return _get_json(url, params)
+
+		key = (symbol, "div", str(start_date), str(end_date))
+		data = spx_cache.get_or_fetch(key, fetch, ttl_seconds=EVENTS_CACHE_TTL)
+		if not data:
+			qt.log.info(f"no dividend data for symbol {symbol}")
+			return pd.DataFrame(columns=list(DIV_DTYPES)).astype(DIV_DTYPES)
+
+		td = pd.json_normalize(data)
+		if "unadjustedValue" in td:
+			td = td.astype({"unadjustedValue": "float32"})
 		qt.log.info(f"returned {td.shape} rows")
 		return td
 
+	# http / network errors are raised so download_data can tell transient from permanent failures
+	except requests.RequestException as e:
+		qt.log.warning(f"couldnt query dividend data for stock {symbol}, error : {e}")
+		raise
+
 	except Exception as e:
 		qt.log.warning(f"couldnt query dividend data for stock {symbol}, error : {e}")
 		return pd.DataFrame()
 
-def date_to_unix(date):
-	return int(pd.to_datetime(date).replace(tzinfo=dt.timezone.utc).timestamp())
+# intraday columns (in file order) and their dtypes
+INTRADAY_DTYPES = {
+	"timestamp": np.int64,
+	"gmtoffset": np.int64,
+	"open": np.float32,
+	"high": np.float32,
+	"low": np.float32,
+	"close": np.float32,
+	"volume": np.int64
+}
+
+def _intraday_columns(rows):
+	"""Converts the api's list of bar dicts into typed numpy columns (null prices -> nan, null volume -> 0)."""
+	columns = {}
+	for col, dtype in INTRADAY_DTYPES.items():
+		missing = np.nan if np.issubdtype(dtype, np.floating) else 0
+		values = (r.get(col) for r in rows)
+		columns[col] = np.fromiter((missing if v is None else v for v in values), dtype=dtype, count=len(rows))
+	return columns
+
+def iter_raw_intraday(symbol, start_dt, end_dt, api_token=EODHD_API_KEY):
+	"""Yields raw 1m intraday data as one typed DataFrame per 100-day chunk (the api allows 120 days). Errors are raised."""
+	# 100-day chunks for safety, as unix second boundaries
+	start_ts = calendar.timegm(start_dt.timetuple())
+	end_ts = calendar.timegm(end_dt.timetuple())
+
+	cursor = start_ts
+	while cursor < end_ts:
+		nxt = min(cursor + 100 * 86400, end_ts)
+		
+		url = f"https://eodhd.com/api/intraday/{symbol}"
+		params = {
+			"api_token": api_token,
+			"interval": "1m",
+			"fmt": "json",
+			"from": cursor,
+			"to": nxt
+		}
+		
+		qt.log.info(f"querying intraday data for symbol {symbol} from {cursor} to {nxt}")
+		def fetch():
+			return _get_json(url, params, timeout=5)
+
+		# a chunk fetched more than a day after its end is immutable, earlier fetches expire
+		key = (symbol, "intraday", params["from"], params["to"])
+		data = spx_cache.get_or_fetch(key, fetch, ttl_seconds=ROLLING_CHUNK_CACHE_TTL, final_after=params["to"] + 24 * 3600)
+		if data:
+			columns = _intraday_columns(data)
+
+			# free the chunk's bar dicts before handing it on
+			del data
+			yield pd.DataFrame(columns)
+		
+		cursor = nxt + 1
 
 def get_raw_intraday(symbol, start_dt, end_dt, api_token=EODHD_API_KEY):
 	"""Downloads raw 1m intraday data, handling the 120-day limit."""
-	all_data = []
-	
 	try:
-
-		current_start = start_dt
-		while current_start < end_dt:
-			# 100-day chunks for safety
-			current_end = min(current_start + dt.timedelta(days=100), end_dt)
-			
-			url = f"https://eodhd.com/api/intraday/{symbol}"
-			params = {
-				"api_token": api_token,
-				"interval": "1m",
-				"fmt": "json",
-				"from": date_to_unix(current_start),
-				"to": date_to_unix(current_end)
-			}
-			
-			qt.log.info(f"querying intraday data for symbol {symbol} from {current_start} to {current_end}")
-			response = requests.get(url, params=params, timeout=5)
-			if response.status_code == 200:
-				all_data.extend(response.json())
-			
-			current_start = current_end + dt.timedelta(seconds=1)
-			time.sleep(0.2) # To respect rate limits
-
-		df = pd.DataFrame(all_data)
+		chunks = list(iter_raw_intraday(symbol, start_dt, end_dt, api_token=api_token))
+		df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
 		if not df.empty:
 			df['datetime'] = pd.to_datetime(df['timestamp'], unit='s', utc=True)
 			df.set_index('datetime', inplace=True)
-			df.rename(columns={'o':'open','h':'high','l':'low','c':'close','v':'volume'}, inplace=True)
 	
+	# http / network errors are raised so download_data can tell transient from permanent failures
+	except requests.RequestException as e:
+		qt.log.warning(f"couldnt get raw intraday data for stock {symbol}, error : {e}")
+		raise
+
 	except Exception as e:
 		qt.log.warning(f"couldnt get raw intraday data for stock {symbol}, error : {e}")
 		df = pd.DataFrame()
 
 	return df
 
-def adjust_intraday_prices(intraday_df, splits_df, div_df):
-	df = intraday_df.copy()
+def _asof_values(event_dates, event_values, dates, default):
+	"""For each date, the value of the latest event on or before it (default before the first event). event_dates must be sorted."""
+	idx = np.searchsorted(event_dates.to_numpy(), dates.to_numpy(), side="right") - 1
+
+	# idx == -1 picks the appended default
+	return np.append(event_values.to_numpy(dtype=np.float64), default)[idx]
 
-	# ensure datetime is timezone-aware
-	df["datetime"] = pd.to_datetime(df["timestamp"], utc=True, unit="s")
+def adjust_intraday_prices(intraday_df, splits_df, div_df):
+	"""Returns a new split / dividend adjusted frame; intraday_df itself is left untouched (no defensive copy)."""
+	# timezone-aware datetime
+	datetime = pd.to_datetime(intraday_df["timestamp"].to_numpy(), utc=True, unit="s")
 
 	# convert to US market timezone
-	df["datetime_us"] = df["datetime"].dt.tz_convert("America/New_York")
+	datetime_us = datetime.tz_convert("America/New_York")
 
-	# add date and time columns
-	df["date"] = df["datetime_us"].dt.date
-	df["time"] = df["datetime_us"].dt.time
+	# date (as naive datetime64 midnight, comparable with split / dividend dates) and time
+	date = datetime_us.tz_localize(None).normalize()
+	time_us = datetime_us.time
 
 	# adding split adjustment
 	splits = splits_df.copy()
-	splits["date"] = pd.to_datetime(splits["date"]).dt.date
+	splits["date"] = pd.to_datetime(splits["date"]).dt.normalize()
 
-	# parse split ratio (e.g. "10.000000/1.000000")
-	splits["ratio"] = splits["split"].apply(
-		lambda x: float(x.split("/")[0]) / float(x.split("/")[1])
-	)
+	# parse split ratio (e.g. "10.000000/1.000000"), reindex keeps both columns when there are no splits
+	parts = splits["split"].str.split("/", n=1, expand=True).reindex(columns=[0, 1]).astype(np.float64)
+	splits["ratio"] = parts[0] / parts[1]
 
 	# create cumulative split adjustment factor
 	splits = splits.sort_values("date")
 	splits["cum_split_factor"] = splits["ratio"][::-1].cumprod()[::-1]
 
-	df = df.merge(
-		splits[["date", "cum_split_factor"]],
-		on="date",
-		how="left"
-	)
-
-	df["cum_split_factor"] = df["cum_split_factor"].ffill().fillna(1.0)
-
-	# apply split adjustment
-	price_cols = ["open", "high", "low", "close"]
-	for c in price_cols:
-		df[c] = df[c] / df["cum_split_factor"]
-
-	df["volume"] = df["volume"] * df["cum_split_factor"]
+	cum_split_factor = _asof_values(splits["date"], splits["cum_split_factor"], date, 1.0)
 
 	# dividend adjustment
 	divs = div_df.copy()
-	divs["date"] = pd.to_datetime(divs["recordDate"]).dt.date
+	divs["date"] = pd.to_datetime(divs["recordDate"]).dt.normalize()
 	divs = divs.sort_values("date")
 
 	divs["cum_div"] = divs["unadjustedValue"][::-1].cumsum()[::-1]
 
-	df = df.merge(
-		divs[["date", "cum_div"]],
-		on="date",
-		how="left"
-	)
+	cum_div = _asof_values(divs["date"], divs["cum_div"], date, 0.0)
 
-	df["cum_div"] = df["cum_div"].ffill().fillna(0.0)
+	# apply split and dividend adjustment to all price columns at once
+	price_cols = ["open", "high", "low", "close"]
+	adj_prices = intraday_df[price_cols].to_numpy() / cum_split_factor[:, None] - cum_div[:, None]
+
+	# assemble the result from the original columns (no copy) plus the adjusted ones
+	columns = {c: intraday_df[c].to_numpy() for c in intraday_df.columns}
+	columns.update({c: adj_prices[:, i] for i, c in enumerate(price_cols)})
+	columns["volume"] = intraday_df["volume"].to_numpy() * cum_split_factor
+	columns.update({
+		"datetime": datetime,
+		"datetime_us": datetime_us,
+		"date": date,
+		"time": time_us,
+		"cum_split_factor": cum_split_factor,
+		"cum_div": cum_div
+	})
+
+	return pd.DataFrame(columns, copy=False)
+
+def _read_saved(file_path, columns=None):
+	"""Reads a saved ticker file (parquet or csv, by extension)."""
+	if str(file_path).endswith(".parquet"):
+		return pd.read_parquet(file_path, columns=columns)
+	# split / div dates stay strings like the api returns them, pyarrow would parse them to dates.
+	# volume can be empty in older files, read it as float and apply _intraday_columns' rule (null -> 0)
+	dtype = {**INTRADAY_DTYPES, "volume": np.float64, "date": "string"}
+	df = pd.read_csv(file_path, usecols=columns, dtype=dtype, engine="pyarrow")
+	if "volume" in df:
+		df["volume"] = df["volume"].fillna(0).astype(np.int64)
+	return df
+
+def _arrow_schema(dtypes):
+	"""Fixed arrow schema for a dataset's {column : dtype} (object / string columns -> string)."""
+	return pa.schema([(c, pa.string() if dtype in ("object", "string") else pa.from_numpy_dtype(np.dtype(dtype))) for c, dtype in dtypes.items()])
+
+def _to_table(t, schema):
+	"""Aligns t to schema (missing columns null, unknown ones dropped) and converts it to an arrow table."""
+	t = t.reindex(columns=schema.names)
+	for field in schema:
+		# integer columns cannot hold nulls, same rule as _intraday_columns (null volume -> 0)
+		if pa.types.is_integer(field.type):
+			t[field.name] = t[field.name].fillna(0)
+	return pa.Table.from_pandas(t, schema=schema, preserve_index=False, safe=False)
+
+def _save(frames, file_path, dtypes):
+	"""
+	Writes an iterable of DataFrames to file_path one at a time, extending the file if it already
+	exists, and returns the number of new rows. Rows are aligned to the dataset's fixed schema
+	built from dtypes. Both formats are written into a .part file (existing rows first) that
+	replaces file_path only once complete, so an interrupted write never leaves a truncated file.
+	"""
+	schema = _arrow_schema(dtypes)
+	file_exists = Path(file_path).is_file()
+	is_parquet = str(file_path).endswith(".parquet")
+	tmp_path = f"{file_path}.part"
+	writer = None
+	rows = 0
+
+	# csv rows are appended by position : align them to the existing file's header
+	if not is_parquet and file_exists:
+		header = pd.read_csv(file_path, nrows=0).columns
+		schema = pa.schema([schema.field(c) if c in schema.names else pa.field(c, pa.string()) for c in header])
+
+	try:
+		for t in frames:
+			if len(t) == 0:
+				continue
+			table = _to_table(t, schema)
+
+			if is_parquet:
+				# open the new file on the first rows, copying the existing ones over first (aligned to
+				# the fixed schema, older files may hold null typed or missing columns)
+				if writer is None:
+					writer = pq.ParquetWriter(tmp_path, schema, compression="zstd", compression_level=3)
+					if file_exists:
+						with pq.ParquetFile(file_path) as existing:
+							for batch in existing.iter_batches():
+								writer.write_table(_to_table(batch.to_pandas(), schema))
+
+				writer.write_table(table)
+
+			else:
+				# copy the existing csv on the first rows, then append (header only for a new file)
+				if writer is None:
+					if file_exists:
+						shutil.copyfile(file_path, tmp_path)
+					writer = open(tmp_path, "ab")
+					if not file_exists:
+						writer.write(pd.DataFrame(columns=table.column_names).to_csv(index=False).encode())
+
+				# pyarrow quotes every string field, so tables with strings (split / div) are written by
+				# pandas to keep the files' format. numeric (intraday) tables need no quoting at all
+				if any(pa.types.is_string(f.type) for f in table.schema):
+					writer.write(table.to_pandas().to_csv(header=False, index=False).encode())
+				else:
+					pv.write_csv(table, writer, write_options=pv.WriteOptions(include_header=False, quoting_style="none"))
+
+			rows += len(t)
+
+	except BaseException:
+		if writer is not None:
+			writer.close()
+		Path(tmp_path).unlink(missing_ok=True)
+		raise
+
+	if writer is not None:
+		writer.close()
+		os.replace(tmp_path, file_path)
+
+	return rows
+
+def _migrate_legacy_csv(file_path, dtypes):
+	"""Converts a ticker's csv (saved before parquet became the default) into file_path once, the csv is left in place."""
+	csv_path = f"{file_path[:-len('.parquet')]}.csv"
+	if str(file_path).endswith(".parquet") and not Path(file_path).is_file() and Path(csv_path).is_file():
+		qt.log.info(f"converting {csv_path} to {file_path}")
+		_save([_read_saved(csv_path)], file_path, dtypes)
+
+def read_saved_data(data_name, sym, columns=None):
+	"""Reads a ticker's saved data/{data_name}/{sym} file : parquet if present, else the csv."""
+	file_path = f"{DATA_DIR}/{data_name}/{sym}.parquet"
+	if not Path(file_path).is_file():
+		file_path = f"{DATA_DIR}/{data_name}/{sym}.csv"
+	return _read_saved(file_path, columns=columns)
+
+def _last_saved(file_path, key_col):
+	"""Returns the last saved value of key_col ("timestamp" or "date") and the date to resume from."""
+	last = _read_saved(file_path, columns=[key_col])[key_col].max()
+	if key_col == "timestamp":
+		resume_dt = dt.datetime.fromtimestamp(int(last), dt.timezone.utc).date()
+	else:
+		resume_dt = pd.to_datetime(last).date()
+	return last, resume_dt
+
+def _download_one(data_name, sym, start_dt, end_dt, file_path, key_col):
+	"""
+	Worker for download_data. Returns (sym, status, value) with status one of
+	  "fetched"    : value is the new rows, for the caller to save
+	  "saved"      : value is the number of rows already streamed to file_path (intraday)
+	  "up_to_date" : nothing new since the last run, value is None
+	  "failed"     : value is the exception
+	If the file already exists only rows after its last key_col value are kept.
+	"""
+	try:
+		# resume from files saved as csv rather than downloading everything again
+		_migrate_legacy_csv(file_path, DATASET_DTYPES[data_name])
+
+		last = None
+		if Path(file_path).is_file():
+			last, resume_dt = _last_saved(file_path, key_col)
+			qt.log.info(f"file for {sym} already exists up to {last}. querying from {resume_dt}")
+			start_dt = max(start_dt, resume_dt)
+
+		# intraday is streamed to disk chunk by chunk, so memory stays flat however many tickers run
+		if data_name == "intraday":
+			chunks = iter_raw_intraday(sym, start_dt, end_dt)
+			if last is not None:
+				chunks = (c[c[key_col] > last] for c in chunks)
+			n_rows = _save(chunks, file_path, INTRADAY_DTYPES)
+			status, value = "saved", n_rows
 
-	for c in price_cols:
-		df[c] = df[c] - df["cum_div"]
+		else:
+			t = DATASETS[data_name](sym, start_dt, end_dt)
+			if last is not None and len(t) != 0:
+				t = t[t[key_col] > last]
+			n_rows = len(t)
+			status, value = "fetched", t
 
-	# cleanup
-	# df = df.drop(columns=["cum_split_factor", "cum_div"])
+		if n_rows == 0:
+			assert last is not None, "0 rows returned"
 
-	return df
+			# nothing new since the last run
+			return sym, "up_to_date", None
+		return sym, status, value
 
-def download_data(fun_to_d, tickers, start_dt, end_dt):
-	fun_to_name = {
-		get_splits : "split",
-		get_dividends : "div",
-		get_raw_intraday : "intraday"
-	}
+	except Exception as e:
+		return sym, "failed", e
+
+def _is_transient(e):
+	"""True for failures worth retrying : rate limiting, 5xx, timeouts and connection errors."""
+	if isinstance(e, requests.HTTPError) and e.response is not None:
+		return e.response.status_code == 429 or e.response.status_code >= 500
+	return isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError))
+
+DATA_DIR = "data"
+KNOWN_BAD_TICKERS_PATH = f"{DATA_DIR}/known_bad_tickers.txt"
+
+# fetch function per dataset name, files are saved under data/{name}/
+DATASETS = {
+	"split": get_splits,
+	"div": get_dividends,
+	"intraday": get_raw_intraday
+}
+
+# column dtypes per dataset, saved files keep this fixed schema
+DATASET_DTYPES = {
+	"split": SPLIT_DTYPES,
+	"div": DIV_DTYPES,
+	"intraday": INTRADAY_DTYPES
+}
+
+# create the dataset directories once
+for _name in DATASETS:
+	Path(f"{DATA_DIR}/{_name}").mkdir(parents=True, exist_ok=True)
+
+# statuses that mean the symbol itself is bad, and ones that mean the whole run is (api key, plan, quota)
+SYMBOL_ERROR_STATUSES = (404,)
+RUN_ERROR_STATUSES = (401, 402, 403)
+
+def _http_status(e):
+	if isinstance(e, requests.HTTPError) and e.response is not None:
+		return e.response.status_code
+	return None
+
+def _permanent_reason(e):
+	"""Reason code (e.g. "http_404") for symbol specific failures that will not go away on a rerun, else None."""
+	status = _http_status(e)
+	return f"http_{status}" if status in SYMBOL_ERROR_STATUSES else None
+
+def load_known_bad_tickers(path=KNOWN_BAD_TICKERS_PATH):
+	"""Returns {ticker : reason} of tickers that permanently failed in earlier runs."""
+	if not Path(path).is_file():
+		return {}
+	with open(path) as f:
+		known_bad = {}
+		for line in f:
+			# lines added by hand may be just the ticker, without a reason
+			sym, _, reason = line.rstrip("\n").partition("\t")
+			if sym.strip():
+				known_bad[sym.strip()] = reason or "manual"
+		return known_bad
+
+def save_known_bad_tickers(failed_tickers, path=KNOWN_BAD_TICKERS_PATH):
+	"""Appends the permanently failed tickers of a download_data run (404 etc, not transient errors) to path."""
+	known_bad = load_known_bad_tickers(path)
+	new_bad = {sym: _permanent_reason(e) for sym, e in failed_tickers.items() if sym not in known_bad}
+	new_bad = {sym: reason for sym, reason in new_bad.items() if reason is not None}
+	if new_bad:
+		qt.log.info(f"adding {len(new_bad)} tickers to {path}")
+		Path(path).parent.mkdir(parents=True, exist_ok=True)
+		with open(path, "a") as f:
+			f.writelines(f"{sym}\t{reason}\n" for sym, reason in new_bad.items())
+
+def clean_tickers(tickers, known_bad=None):
+	"""Normalizes (strip, upper case), dedupes and drops placeholder and known bad tickers, keeping order."""
+	known_bad = known_bad or {}
+	tickers = [t.strip().upper() for t in tickers if isinstance(t, str)]
+	tickers = [t for t in dict.fromkeys(tickers) if t and t != "-" and t not in known_bad]
+	return tickers
+
+def download_data(data_name, tickers, start_dt, end_dt, max_workers=8, file_format="parquet"):
+	"""
+	Downloads the data_name ("split", "div" or "intraday") dataset for each ticker into
+	data/{data_name}/{ticker}.{file_format} ("parquet" or "csv"). The dataset's fetch function
+	is accepted in place of its name for older callers.
+	"""
+	# dataset name (looked up by function name, identity changes across module reloads)
+	if callable(data_name):
+		data_name = {f.__name__: name for name, f in DATASETS.items()}[data_name.__name__]
+
+	file_dir = f"{DATA_DIR}/{data_name}/"
+
+	# make sure every worker thread can keep its own connection alive
+	if max_workers > POOL_MAXSIZE:
+		size_session_pool(max_workers)
+
+	# column used to resume an existing file from
+	key_col = "timestamp" if data_name == "intraday" else "date"
+
+	def download_batch(syms):
+		"""Queries syms in parallel (io bound) and saves them. Returns {sym : exception} for failures."""
+		failed = {}
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			futures = []
+			for sym in syms:
+				file_path = f"{file_dir}/{sym}.{file_format}"
+				qt.log.info(f"querying {data_name} data for symbol {sym}")
+				futures.append(executor.submit(_download_one, data_name, sym, start_dt, end_dt, file_path, key_col))
 
-	# dataset name
-	data_name = fun_to_name[fun_to_d]
+			for future in as_completed(futures):
+				sym, status, value = future.result()
+				file_path = f"{file_dir}/{sym}.{file_format}"
 
-	# create directory if doesnt exist
-	csv_path_dir = f"data/{data_name}/"
-	Path(csv_path_dir).mkdir(parents=True, exist_ok=True)
+				# the ticker's responses are in its file now (cache keys carry the query dates, so
+				# they would never be read again) : drop its cached json
+				if status == "up_to_date":
+					qt.log.info(f"no new {data_name} data for symbol {sym}")
+					spx_cache.evict(sym, data_name)
+					continue
 
-	# failed tickers
-	failed_tickers = {}
+				# already streamed to file by the worker
+				if status == "saved":
+					qt.log.info(f"saved {value} rows for symbol {sym} to file {file_path}")
+					spx_cache.evict(sym, data_name)
+					continue
 
-	for sym in tickers:
-		csv_file_path = f"{csv_path_dir}/{sym}.csv"
+				try:
+					if status == "failed":
+						raise value
 
-		if Path(csv_file_path).is_file():
-			qt.log.info(f"csv file for {sym} already exists. skip")
-			continue
-	
-		else:
-			try:
-				qt.log.info(f"querying {data_name} data for symbol {sym}")
-				t = fun_to_d(sym, start_dt, end_dt)
-				if len(t) != 0:
-					qt.log.info(f"saving {t.shape} rows for symbol {sym} to file {csv_file_path}")
-					t.to_csv(csv_file_path, index=False)
+					qt.log.info(f"saving {value.shape} rows for symbol {sym} to file {file_path}")
+					_save([value], file_path, DATASET_DTYPES[data_name])
+					spx_cache.evict(sym, data_name)
 
-				# 
-				else:
-					assert False, "0 rows returned"
+					# delete table variable
+					del value
+
+				except Exception as e:
+					# rejected key / plan / quota fails every ticker alike : stop instead of recording them
+					status = _http_status(e)
+					if status in RUN_ERROR_STATUSES:
+						executor.shutdown(cancel_futures=True)
+						raise RuntimeError(f"eodhd rejected the request ({status}), check EODHD_API_KEY and the account's plan / quota") from e
 
-				# delete table variable
-				del t
+					qt.log.warning(f"error occurred with ticker : {sym}, error : {e}")
+					failed[sym] = e
 
-			except Exception as e:
-				qt.log.warning(f"error occurred with ticker : {sym}, error : {e}")
-				failed_tickers[sym] = e
+		return failed
+
+	# failed tickers
+	failed_tickers = download_batch(tickers)
+
+	# retry transient failures with jittered exponential backoff
+	for attempt in range(3):
+		to_retry = [sym for sym, e in failed_tickers.items() if _is_transient(e)]
+		if not to_retry:
+			break
+
+		time.sleep(2 ** attempt + random.random())
+		qt.log.info(f"retrying {len(to_retry)} tickers, attempt {attempt + 1}")
+		for sym in to_retry:
+			del failed_tickers[sym]
+		failed_tickers.update(download_batch(to_retry))
 	
-	return failed_tickers
\ No newline at end of file
+	return failed_tickers